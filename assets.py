@@ -0,0 +1,92 @@
+# SPDX-FileCopyrightText: 2024 Jean Basset <jean.basset@inria.fr>
+
+# SPDX-License-Identifier: CECILL-2.1
+
+import bpy
+import os
+import re
+from bpy.app.handlers import persistent
+
+ASSETS_FILE = "smear_frames_nodes.blend"
+
+# Increase when the node groups or materials of the assets file change, so that files baked with an older version get updated
+ASSETS_VERSION = 1
+
+ASSETS = {
+	"node_groups": ["Smear Frames Controler","Smear Frames Controler - Multiples","Smear Frames Controler - Lines"],
+	"materials": ["Delta_Visualization","MultipleTransparency"]
+}
+
+# Datablocks already checked or loaded during this session, by (data collection, name)
+loaded_assets = {}
+
+def get_assets_filepath():
+	return os.path.join(os.path.dirname(os.path.realpath(__file__)), ASSETS_FILE)
+
+def is_current(datablock):
+	return datablock is not None and datablock.get("smear_assets_version") == ASSETS_VERSION
+
+def get_missing_assets():
+	missing = {}
+	for data_name, names in ASSETS.items():
+		collection = getattr(bpy.data,data_name)
+		for name in names:
+			datablock = collection.get(name)
+			if loaded_assets.get((data_name,name)) == datablock and datablock is not None:
+				continue
+			if is_current(datablock):
+				loaded_assets[(data_name,name)] = datablock
+				continue
+			missing.setdefault(data_name,[]).append(name)
+	return missing
+
+def load_assets():
+	missing = get_missing_assets()
+	if len(missing) == 0:
+		return
+
+	# Node groups bring the node groups and materials they use along with them: reloading only some of them
+	# would append .001 copies of the others. The whole set is reloaded instead.
+	if "node_groups" in missing:
+		missing = {data_name: list(names) for data_name, names in ASSETS.items()}
+
+	existing_datablocks = {data_name: set(getattr(bpy.data,data_name)) for data_name in ASSETS}
+
+	# A single pass over the library. Node groups used by the main node group are loaded along with it.
+	with bpy.data.libraries.load(get_assets_filepath(),link=False) as (data_from,data_to):
+		for data_name, names in missing.items():
+			setattr(data_to,data_name,names)
+
+	for data_name, names in missing.items():
+		collection = getattr(bpy.data,data_name)
+		for name, datablock in zip(names,getattr(data_to,data_name)):
+			if datablock is None:
+				raise RuntimeError(f"{name} not found in {ASSETS_FILE}")
+
+			# Replace outdated versions instead of piling up .001 copies
+			existing = collection.get(name)
+			if existing is not None and existing != datablock:
+				existing.user_remap(datablock)
+				collection.remove(existing)
+			datablock.name = name
+			datablock["smear_assets_version"] = ASSETS_VERSION
+			loaded_assets[(data_name,name)] = datablock
+
+	remove_dependency_copies(existing_datablocks)
+
+def remove_dependency_copies(existing_datablocks):
+	# "<name>.NNN" copies of the assets appended as dependencies by the load are replaced by the current datablocks
+	for data_name, names in ASSETS.items():
+		collection = getattr(bpy.data,data_name)
+		for name in names:
+			datablock = collection.get(name)
+			if datablock is None:
+				continue
+			copies = [d for d in collection if not d in existing_datablocks[data_name] and d != datablock and re.fullmatch(re.escape(name) + r"\.\d{3,}",d.name)]
+			for copy in copies:
+				copy.user_remap(datablock)
+				collection.remove(copy)
+
+@persistent
+def clear_loaded_assets(dummy):
+	loaded_assets.clear()
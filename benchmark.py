@@ -0,0 +1,140 @@
+# SPDX-FileCopyrightText: 2024 Jean Basset <jean.basset@inria.fr>
+
+# SPDX-License-Identifier: CECILL-2.1
+
+import bpy
+import json
+import time
+import numpy as np
+
+from .utils import get_modifier_input, set_modifier_input
+
+def get_sweep_values(item,value,n_samples):
+	# Booleans are tried both ways. Bounded factors such as probabilities are sampled over their range,
+	# other numbers are scaled up from their current value, as the cost of the effects grows with them.
+	if item.socket_type == "NodeSocketBool":
+		return [False,True]
+
+	is_int = item.socket_type == "NodeSocketInt"
+	min_value, max_value = item.min_value, item.max_value
+	if not is_int and max_value - min_value <= 1:
+		return [float(v) for v in np.linspace(min_value,max_value,n_samples)]
+
+	base = value if value > 0 else 1
+	values = [min(max_value,max(min_value,base*2**k)) for k in range(n_samples)]
+	if is_int:
+		values = [int(round(v)) for v in values]
+	return sorted(set(values))
+
+def count_output(obj,depsgraph):
+	# The mesh of the object and the other geometry components generated by its modifiers (e.g. motion lines curves)
+	vertices = 0
+	curves = 0
+	for instance in depsgraph.object_instances:
+		source = instance.parent if instance.is_instance else instance.object
+		if source is None or source.original != obj:
+			continue
+		data = instance.object.data
+		if isinstance(data,bpy.types.Mesh):
+			vertices += len(data.vertices)
+		elif isinstance(data,bpy.types.Curves):
+			curves += len(data.curves)
+			vertices += len(data.points)
+		elif isinstance(data,bpy.types.Curve):
+			curves += len(data.splines)
+	return vertices, curves
+
+def time_playback(scene,obj,frames):
+	obj.update_tag()
+	# Not timed, the first evaluation after a change of settings rebuilds the node tree
+	scene.frame_set(frames[0])
+
+	frame_times = []
+	vertices = []
+	curves = []
+	for frame in frames:
+		start = time.perf_counter()
+		scene.frame_set(frame)
+		depsgraph = bpy.context.evaluated_depsgraph_get()
+		frame_times.append(time.perf_counter()-start)
+
+		n_vertices, n_curves = count_output(obj,depsgraph)
+		vertices.append(n_vertices)
+		curves.append(n_curves)
+
+	frame_times = np.array(frame_times)
+	return {
+		"frame_times": frame_times.tolist(),
+		"mean_time": float(frame_times.mean()),
+		"median_time": float(np.median(frame_times)),
+		"max_time": float(frame_times.max()),
+		"fps": float(1/frame_times.mean()) if frame_times.mean() > 0 else None,
+		"vertices": vertices,
+		"max_vertices": max(vertices),
+		"curves": curves,
+		"max_curves": max(curves)
+	}
+
+def run_benchmark(scene,obj,effects,n_samples=4,frame_step=1):
+	# effects: list of (label, activation toggle, [(parameter name, gate)]), as in the effect panels.
+	# The baseline runs with every effect off, then each effect is turned on alone and its parameters
+	# are swept one at a time, the others keeping their current value. The gate of a parameter, if any,
+	# is enabled while it is swept.
+	mod = obj.modifiers["Smear Control Panel"]
+	items = mod.node_group.interface.items_tree
+	frames = list(range(get_modifier_input(mod,"First Frame"),get_modifier_input(mod,"Last Frame")+1,frame_step))
+
+	toggles = [toggle for (_,toggle,_) in effects]
+	parameters = [parameter for (_,_,effect_parameters) in effects for parameter in effect_parameters]
+	names = toggles + [name for (name,_) in parameters] + [gate for (_,gate) in parameters if gate is not None]
+	initial = {name: get_modifier_input(mod,name) for name in names}
+	current_frame = scene.frame_current
+
+	results = {
+		"blend_file": bpy.data.filepath,
+		"object": obj.name,
+		"blender_version": bpy.app.version_string,
+		"frames": [frames[0],frames[-1],frame_step],
+		"runs": []
+	}
+
+	def run(effect,parameter=None,value=None,gate=None):
+		result = {"effect": effect,"parameter": parameter,"value": value,"gate": gate}
+		result.update(time_playback(scene,obj,frames))
+		results["runs"].append(result)
+		print(f"SMEAR benchmark: {effect} {'' if parameter is None else f'{parameter}={value} '}{result['mean_time']*1000:.2f} ms/frame, {result['max_vertices']} vertices, {result['max_curves']} curves")
+
+	try:
+		for toggle in toggles:
+			set_modifier_input(mod,toggle,False)
+		run("Baseline")
+
+		for (label,toggle,parameters) in effects:
+			set_modifier_input(mod,toggle,True)
+			run(label)
+
+			for (name,gate) in parameters:
+				item = items[name]
+				if not item.socket_type in ["NodeSocketBool","NodeSocketInt","NodeSocketFloat"]:
+					continue
+				if gate is not None:
+					set_modifier_input(mod,gate,True)
+				for value in get_sweep_values(item,initial[name],n_samples):
+					set_modifier_input(mod,name,value)
+					run(label,name,value,gate)
+				set_modifier_input(mod,name,initial[name])
+				if gate is not None:
+					set_modifier_input(mod,gate,initial[gate])
+
+			set_modifier_input(mod,toggle,False)
+	finally:
+		for name, value in initial.items():
+			set_modifier_input(mod,name,value)
+		obj.update_tag()
+		scene.frame_set(current_frame)
+
+	return results
+
+def write_results(filepath,results):
+	with open(filepath,'w') as f:
+		json.dump(results,f,indent=4)
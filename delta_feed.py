@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: 2024 Jean Basset <jean.basset@inria.fr>
+
+# SPDX-License-Identifier: CECILL-2.1
+
+import bpy
+import os
+import re
+import numpy as np
+from bpy.app.handlers import persistent
+from . import point_cache
+
+# Number of neighbouring frames written on each side of the current frame
+FEED_RADIUS = 1
+
+# Memory-mapped delta caches, by file path
+loaded_caches = {}
+
+# Names of the objects being baked, their deltas are not fed to their mesh, which is shared with the copy used for sampling
+suspended = set()
+
+def get_delta_cache_filepath(obj,suffix=""):
+	directory = bpy.path.abspath("//") if bpy.data.filepath != "" else bpy.app.tempdir
+	return os.path.join(directory,f"{bpy.path.clean_name(obj.name + suffix)}_deltas.npy")
+
+def get_delta_cache(filepath):
+	cache = loaded_caches.get(filepath)
+	if cache is None:
+		cache = np.load(filepath,mmap_mode='r')
+		loaded_caches[filepath] = cache
+	return cache
+
+def save_delta_cache(obj,animation_deltas,suffix="",previous_range=None):
+	# Deltas of frames [frame_start, frame_end] are stored as a (n_frames, n_vertices) array.
+	# The deltas of a previous bake over previous_range are kept, frames with no delta are zero.
+	filepath = get_delta_cache_filepath(obj,suffix)
+	frame_start, frame_end = min(animation_deltas), max(animation_deltas)
+
+	previous = None
+	if previous_range is not None and os.path.exists(filepath):
+		# Loaded in memory, as the file is overwritten below
+		previous = np.load(filepath)
+		frame_start = min(frame_start,previous_range[0])
+		frame_end = max(frame_end,previous_range[1])
+
+	loaded_caches.pop(filepath,None)
+
+	n_vertices = len(next(iter(animation_deltas.values())))
+	cache = np.lib.format.open_memmap(filepath,mode='w+',dtype=np.float32,shape=(frame_end-frame_start+1,n_vertices))
+	cache[:] = 0
+	if previous is not None:
+		cache[previous_range[0]-frame_start:previous_range[0]-frame_start+len(previous)] = previous
+	for frame, delta in animation_deltas.items():
+		cache[frame-frame_start] = delta
+	cache.flush()
+	del cache
+
+	return filepath, frame_start, frame_end
+
+def set_delta_cache(obj,filepath,frame_range=None):
+	obj["smear_delta_cache"] = bpy.path.relpath(filepath) if bpy.data.filepath != "" else filepath
+	if frame_range is not None:
+		obj["smear_delta_frames"] = list(frame_range)
+	clear_delta_feed(obj)
+
+def remove_delta_cache(obj):
+	for key in ["smear_delta_cache","smear_delta_frames"]:
+		if key in obj:
+			del obj[key]
+
+def clear_delta_feed(obj):
+	attributes = obj.data.attributes
+	for name in [at.name for at in attributes if re.fullmatch(r"delta_-?\d+",at.name)]:
+		attributes.remove(attributes[name])
+
+def update_delta_feed(obj,frame):
+	filepath = bpy.path.abspath(obj["smear_delta_cache"])
+	if not os.path.exists(filepath):
+		return
+	cache = get_delta_cache(filepath)
+	frame_start, frame_end = obj["smear_delta_frames"]
+
+	needed = {f"delta_{f}": f for f in range(max(frame_start,frame-FEED_RADIUS),min(frame_end,frame+FEED_RADIUS)+1)}
+
+	# The attributes of frames that are not needed anymore are renamed and reused
+	attributes = obj.data.attributes
+	fed = [at.name for at in attributes if re.fullmatch(r"delta_-?\d+",at.name)]
+	stale = [name for name in fed if not name in needed]
+	for name in needed:
+		if name in attributes:
+			continue
+		if len(stale) > 0:
+			attributes[stale.pop()].name = name
+		else:
+			attributes.new(name=name,type="FLOAT",domain="POINT")
+		attributes[name].data.foreach_set("value",np.ascontiguousarray(cache[needed[name]-frame_start]))
+
+	for name in stale:
+		attributes.remove(attributes[name])
+
+@persistent
+def delta_feed_handler(scene,depsgraph=None):
+	suspended_meshes = [bpy.data.objects[name].data for name in suspended if name in bpy.data.objects]
+	for obj in scene.objects:
+		if obj.type == "MESH" and "smear_delta_cache" in obj and not obj.data in suspended_meshes and not point_cache.is_frozen(obj):
+			update_delta_feed(obj,scene.frame_current)
+
+@persistent
+def clear_loaded_caches(dummy):
+	loaded_caches.clear()
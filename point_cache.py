@@ -0,0 +1,206 @@
+# SPDX-FileCopyrightText: 2024 Jean Basset <jean.basset@inria.fr>
+
+# SPDX-License-Identifier: CECILL-2.1
+
+import bpy
+import os
+import numpy as np
+from bpy.app.handlers import persistent
+
+# http://mattebb.com/projects/houdini/pc2/ : 32 bytes header followed by float32 (x,y,z) for every point of every sample
+PC2_HEADER = np.dtype([('signature','S12'),('version','<i4'),('n_points','<i4'),('start_frame','<f4'),('sample_rate','<f4'),('n_samples','<i4')])
+
+FROZEN_MODIFIER_NAME = "Smear Cache"
+REALIZE_NAME = "Smear Freeze Realize"
+
+def open_pc2(filepath,n_points,n_samples,start_frame,sample_rate=1.0):
+	header = np.array([(b'POINTCACHE2',1,n_points,start_frame,sample_rate,n_samples)],dtype=PC2_HEADER)
+	with open(filepath,'wb') as f:
+		header.tofile(f)
+		f.truncate(PC2_HEADER.itemsize + n_samples*n_points*3*4)
+
+	return np.memmap(filepath,dtype='<f4',mode='r+',offset=PC2_HEADER.itemsize,shape=(n_samples,n_points,3))
+
+def get_cache_filepath(obj):
+	directory = bpy.path.abspath("//") if bpy.data.filepath != "" else bpy.app.tempdir
+	return os.path.join(directory,f"{bpy.path.clean_name(obj.name)}_smears.pc2")
+
+def is_frozen(obj):
+	return "smear_frozen_modifiers" in obj
+
+def get_realize_node_group():
+	# Realizes instances and turns curves (e.g. motion lines) into tubes following their radius,
+	# so that the evaluated mesh holds the whole result of the effects
+	node_group = bpy.data.node_groups.get(REALIZE_NAME)
+	if node_group is not None:
+		return node_group
+
+	node_group = bpy.data.node_groups.new(REALIZE_NAME,'GeometryNodeTree')
+	node_group.interface.new_socket("Geometry",in_out='INPUT',socket_type='NodeSocketGeometry')
+	node_group.interface.new_socket("Geometry",in_out='OUTPUT',socket_type='NodeSocketGeometry')
+
+	nodes = node_group.nodes
+	links = node_group.links
+	group_input = nodes.new('NodeGroupInput')
+	group_output = nodes.new('NodeGroupOutput')
+	realize = nodes.new('GeometryNodeRealizeInstances')
+	profile = nodes.new('GeometryNodeCurvePrimitiveCircle')
+	profile.inputs["Radius"].default_value = 1.0
+	curve_to_mesh = nodes.new('GeometryNodeCurveToMesh')
+	join = nodes.new('GeometryNodeJoinGeometry')
+
+	links.new(group_input.outputs[0],realize.inputs["Geometry"])
+	links.new(realize.outputs["Geometry"],curve_to_mesh.inputs["Curve"])
+	links.new(profile.outputs["Curve"],curve_to_mesh.inputs["Profile Curve"])
+	links.new(realize.outputs["Geometry"],join.inputs["Geometry"])
+	links.new(curve_to_mesh.outputs["Mesh"],join.inputs["Geometry"])
+	links.new(join.outputs["Geometry"],group_output.inputs[0])
+
+	return node_group
+
+def add_realize_modifier(obj):
+	mod = obj.modifiers.new(REALIZE_NAME,"NODES")
+	mod.node_group = get_realize_node_group()
+	return mod
+
+def remove_realize_modifier(obj):
+	if REALIZE_NAME in obj.modifiers:
+		obj.modifiers.remove(obj.modifiers[REALIZE_NAME])
+	node_group = bpy.data.node_groups.get(REALIZE_NAME)
+	if node_group is not None and node_group.users == 0:
+		bpy.data.node_groups.remove(node_group)
+
+def write_point_cache(obj,frame_start,frame_end,filepath):
+	# Streams the evaluated vertex positions of every frame to the cache.
+	# Returns None if the number of vertices changes during the animation.
+	depsgraph = bpy.context.evaluated_depsgraph_get()
+	wm = bpy.context.window_manager
+	wm.progress_begin(0,frame_end-frame_start)
+
+	cache = None
+	try:
+		for frame in range(frame_start,frame_end+1):
+			bpy.context.scene.frame_set(frame)
+			wm.progress_update(frame-frame_start)
+			ob_eval = obj.evaluated_get(depsgraph)
+			vertices = ob_eval.data.vertices
+
+			if cache is None:
+				cache = open_pc2(filepath,len(vertices),frame_end-frame_start+1,frame_start)
+			elif len(vertices) != cache.shape[1]:
+				del cache
+				os.remove(filepath)
+				return None
+
+			vertices.foreach_get('co',cache[frame-frame_start].ravel())
+
+		cache.flush()
+		return cache.shape[1]
+	finally:
+		wm.progress_end()
+
+def write_mesh_cache(obj,frame_start,frame_end):
+	# Fallback when the smear effects change the topology: one mesh per frame, swapped at playback
+	depsgraph = bpy.context.evaluated_depsgraph_get()
+	wm = bpy.context.window_manager
+	wm.progress_begin(0,frame_end-frame_start)
+
+	for frame in range(frame_start,frame_end+1):
+		bpy.context.scene.frame_set(frame)
+		wm.progress_update(frame-frame_start)
+		ob_eval = obj.evaluated_get(depsgraph)
+		mesh = bpy.data.meshes.new_from_object(ob_eval)
+		mesh.name = f"{obj.name}_frozen_{frame}"
+		mesh.use_fake_user = True
+
+	wm.progress_end()
+
+def freeze_smears(obj,frame_start,frame_end,filepath):
+	current_frame = bpy.context.scene.frame_current
+
+	# Only the mesh of the evaluated object is captured, instances and curves are converted to it during the capture
+	add_realize_modifier(obj)
+	try:
+		n_points = write_point_cache(obj,frame_start,frame_end,filepath)
+		if n_points is None:
+			write_mesh_cache(obj,frame_start,frame_end)
+
+		original_mesh = obj.data
+		frozen_mesh = None
+		if n_points is not None and n_points != len(original_mesh.vertices):
+			# The cache can only deform a mesh with the same vertex count, use the evaluated mesh as rest shape
+			bpy.context.scene.frame_set(frame_start)
+			ob_eval = obj.evaluated_get(bpy.context.evaluated_depsgraph_get())
+			frozen_mesh = bpy.data.meshes.new_from_object(ob_eval)
+			frozen_mesh.name = f"{obj.name}_frozen"
+	finally:
+		remove_realize_modifier(obj)
+
+	obj["smear_frozen_modifiers"] = {
+		"viewport": [mod.name for mod in obj.modifiers if mod.show_viewport],
+		"render": [mod.name for mod in obj.modifiers if mod.show_render]
+	}
+	for mod in obj.modifiers:
+		mod.show_viewport = False
+		mod.show_render = False
+
+	# Keep the original mesh in the file while it is swapped out
+	obj["smear_original_mesh"] = original_mesh.name
+	original_mesh.use_fake_user = True
+
+	if n_points is None:
+		obj["smear_frozen_frames"] = [frame_start,frame_end]
+	else:
+		if frozen_mesh is not None:
+			obj.data = frozen_mesh
+
+		mod = obj.modifiers.new(FROZEN_MODIFIER_NAME,"MESH_CACHE")
+		mod.cache_format = 'PC2'
+		mod.filepath = bpy.path.relpath(filepath) if bpy.data.filepath != "" else filepath
+		mod.frame_start = frame_start
+		mod.forward_axis = 'POS_Y'
+		mod.up_axis = 'POS_Z'
+
+	bpy.context.scene.frame_set(current_frame)
+	frozen_frames_handler(bpy.context.scene)
+
+def unfreeze_smears(obj):
+	meshes = bpy.data.meshes
+	frozen_data = obj.data
+	obj.data = meshes[obj["smear_original_mesh"]]
+	obj.data.use_fake_user = False
+	if frozen_data != obj.data:
+		meshes.remove(frozen_data)
+
+	if "smear_frozen_frames" in obj:
+		frame_start, frame_end = obj["smear_frozen_frames"]
+		for frame in range(frame_start,frame_end+1):
+			name = f"{obj.name}_frozen_{frame}"
+			if name in meshes:
+				meshes.remove(meshes[name])
+		del obj["smear_frozen_frames"]
+
+	if FROZEN_MODIFIER_NAME in obj.modifiers:
+		obj.modifiers.remove(obj.modifiers[FROZEN_MODIFIER_NAME])
+
+	for name in obj["smear_frozen_modifiers"]["viewport"]:
+		if name in obj.modifiers:
+			obj.modifiers[name].show_viewport = True
+	for name in obj["smear_frozen_modifiers"]["render"]:
+		if name in obj.modifiers:
+			obj.modifiers[name].show_render = True
+
+	del obj["smear_frozen_modifiers"]
+	del obj["smear_original_mesh"]
+
+@persistent
+def frozen_frames_handler(scene):
+	for obj in scene.objects:
+		if obj.type != "MESH" or not "smear_frozen_frames" in obj:
+			continue
+
+		frame_start, frame_end = obj["smear_frozen_frames"]
+		frame = max(frame_start,min(frame_end,scene.frame_current))
+		mesh = bpy.data.meshes.get(f"{obj.name}_frozen_{frame}")
+		if mesh is not None and obj.data != mesh:
+			obj.data = mesh
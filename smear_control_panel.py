@@ -14,8 +14,15 @@ from bpy.utils import resource_path
 from pathlib import Path
 
 from . import deltas_generation_functions as deltagen
+from . import point_cache
+from . import assets
+from . import delta_feed
+from . import benchmark
 from .utils import *
 
+def get_camera_names(self, context, edit_text):
+    return [o.name for o in context.scene.objects if o.type == "CAMERA"]
+
 def get_bone_names(self, context, edit_text):
     bone_names = []
     if context.active_object.type == "MESH":
@@ -66,11 +73,37 @@ class SmearControlPanel(Panel,bpy.types.Panel):
         col.label(text="Temporal smoothing window:")
         col.prop(scene.smear,"smoothWindow")
 
+        col.label(text="Hold detection tolerance:")
+        col.prop(scene.smear,"holdTolerance")
+
         if bpy.context.scene.camera != None:
             col.prop(scene.smear,"cameraPOV")
+            if scene.smear.cameraPOV:
+                col.label(text="Enter cameras separated by \",\".")
+                col.prop(scene.smear,"povCameras")
+
+        if isMesh and len(obj.get("smear_cameras",[])) > 1:
+            col.operator_menu_enum(SwitchSmearCameraOperator.bl_idname,"camera",text=f"POV Camera: {obj['smear_active_camera']}")
+
+        col.label(text="Bake range:")
+        col.prop(scene.smear,"bakeRange",text="")
+        if scene.smear.bakeRange == "CUSTOM":
+            row = col.row(align=True)
+            row.prop(scene.smear,"rangeStart")
+            row.prop(scene.smear,"rangeEnd")
+        elif scene.smear.bakeRange == "LIST":
+            col.prop(scene.smear,"rangeList")
+        col.prop(scene.smear,"mergeBake")
+        col.prop(scene.smear,"pipelinedBake")
+        col.prop(scene.smear,"runtimeDeltas")
 
         col.operator(BakeDeltasTrajectoriesOperator.bl_idname)
 
+        if isMesh and point_cache.is_frozen(obj):
+            col.operator(UnfreezeSmearsOperator.bl_idname)
+        else:
+            col.operator(FreezeSmearsOperator.bl_idname)
+
 class EffectControlPanel(Panel,bpy.types.Panel):
     bl_space_type = "VIEW_3D"
     bl_region_type = "UI"
@@ -100,9 +133,11 @@ class EffectControlPanel(Panel,bpy.types.Panel):
             col.label(text="and run Bake Smears")
 
 class GN_parameter():
-    def __init__(self, name, as_attribute=False):
+    # gate: name of the boolean parameter that must be enabled for this parameter to have an effect
+    def __init__(self, name, as_attribute=False, gate=None):
         self.name = name
         self.as_attribute = as_attribute
+        self.gate = gate
 
 class ElongatedInbetweensControlPanel(EffectControlPanel,bpy.types.Panel):
     bl_idname = "VIEW3D_PT_ElongatedInbetweensControlPanel"
@@ -118,11 +153,11 @@ class ElongatedInbetweensControlPanel(EffectControlPanel,bpy.types.Panel):
             GN_parameter("Smear Past Length"),
             GN_parameter("Smear Future Length"),
             GN_parameter("Weight by Speed"),
-            GN_parameter("Speed Factor"),
+            GN_parameter("Speed Factor", gate="Weight by Speed"),
             GN_parameter("Add Noise Pattern"),
-            GN_parameter("Noise Scale"),
+            GN_parameter("Noise Scale", gate="Add Noise Pattern"),
             GN_parameter("Manual Weights"),
-            GN_parameter("Manual Weights Group", as_attribute=True)
+            GN_parameter("Manual Weights Group", as_attribute=True, gate="Manual Weights")
         ]
 
 class MultipleInbetweensControlPanel(EffectControlPanel,bpy.types.Panel):
@@ -142,7 +177,7 @@ class MultipleInbetweensControlPanel(EffectControlPanel,bpy.types.Panel):
             GN_parameter("Future Displacement"),
             GN_parameter("Past Displacement"),
             GN_parameter("Overlap"),
-            GN_parameter("Number of Overlap"),
+            GN_parameter("Number of Overlap", gate="Overlap"),
             GN_parameter("Multiple Speed Threshold")
         ]
 
@@ -168,100 +203,687 @@ class MotionLinesControlPanel(EffectControlPanel,bpy.types.Panel):
             GN_parameter("Line Material")
         ]
 
+    def draw(self, context):
+        super().draw(context)
+
+        obj = context.active_object
+        if (not obj is None) and obj.type == "MESH" and "Smear Control Panel" in obj.modifiers:
+            self.layout.operator(ExportMotionLinesOperator.bl_idname)
+
 def clear_attributes(obj):
     attributes = obj.data.attributes
     to_remove = []
     for at in attributes:
-        if at.name.startswith("upsampled") or at.name.startswith("delta") or at.name.startswith("velocities") or at.name.startswith("positions"):
+        if at.name.startswith("upsampled") or at.name.startswith("delta"):
             to_remove.append(at.name)
 
     for name in to_remove:
         obj.data.attributes.remove(obj.data.attributes[name])
 
+def set_motion_attributes(aggregated,velocities):
+    # Per-vertex velocity and speed of every baked frame, stored alongside the aggregated positions
+    velocities = velocities.reshape(-1,3)
+    speeds = np.linalg.norm(velocities,axis=1)
+
+    attributes = aggregated.data.attributes
+    for name in ["velocity","speed"]:
+        if name in attributes:
+            attributes.remove(attributes[name])
+
+    attributes.new(name="velocity",type="FLOAT_VECTOR",domain="POINT")
+    attributes["velocity"].data.foreach_set("vector",velocities.astype(np.float32).ravel())
+    attributes.new(name="speed",type="FLOAT",domain="POINT")
+    attributes["speed"].data.foreach_set("value",speeds.astype(np.float32))
+
+def write_aggregated(obj,positions,velocities,suffix=""):
+    frames = range(min(positions),max(positions)+1)
+    pos_aggregated = np.empty((len(frames),)+positions[frames[0]].shape)
+    vel_aggregated = np.zeros_like(pos_aggregated)
+
+    # Frames between baked ranges hold the last baked position
+    held_frame = frames[0]
+    for i, frame in enumerate(frames):
+        if frame in positions:
+            held_frame = frame
+            vel_aggregated[i] = velocities[frame]
+        pos_aggregated[i] = positions[held_frame]
+
+    aggregated = add_mesh_to_scene(f"aggregated_animation_{obj.name}{suffix}",verts=pos_aggregated.reshape(-1,3),edges=[],faces=[])
+    set_motion_attributes(aggregated,vel_aggregated)
+    aggregated.hide_viewport = True
+    aggregated.hide_render = True
+    aggregated.select_set(False)
+
+    return frames[0], frames[-1]
+
+def read_aggregated(obj,suffix=""):
+    mod = obj.modifiers.get("Smear Control Panel")
+    if mod is None or get_modifier_input(mod,"Aggregated") is None:
+        return {}, {}
+
+    # Aggregated positions of other cameras are stored with a suffix, and share the frame range of the active one
+    aggregated = get_modifier_input(mod,"Aggregated") if suffix == "" else bpy.data.objects.get(f"aggregated_animation_{obj.name}{suffix}")
+    if aggregated is None:
+        return {}, {}
+
+    frame_start, pos_aggregated = get_baked_positions(obj,aggregated)
+    vel_aggregated = np.zeros(pos_aggregated.size,dtype=np.float32)
+    if "velocity" in aggregated.data.attributes:
+        aggregated.data.attributes["velocity"].data.foreach_get("vector",vel_aggregated)
+    vel_aggregated.shape = pos_aggregated.shape
+
+    frames = range(frame_start,frame_start+len(pos_aggregated))
+    positions = {frame: pos_aggregated[i] for i, frame in enumerate(frames)}
+    velocities = {frame: vel_aggregated[i] for i, frame in enumerate(frames)}
+    return positions, velocities
+
+def write_delta_attributes(obj,animation_deltas,suffix=""):
+    attributes = obj.data.attributes
+    for frame in animation_deltas:
+        dname = f"delta_{frame}{suffix}"
+        if dname in attributes:
+            attributes.remove(attributes[dname])
+        attributes.new(name=dname,type="FLOAT",domain="POINT")
+        attributes[dname].data.foreach_set("value",animation_deltas[frame])
+
+def get_camera_suffix(camera_name):
+    return f"@{camera_name}"
+
+def clear_camera_aggregated(obj):
+    objs = bpy.data.objects
+    for name in [o.name for o in objs if o.name.startswith(f"aggregated_animation_{obj.name}@")]:
+        objs.remove(objs[name],do_unlink=True)
+
+def switch_smear_camera(obj,camera_name):
+    # The deltas and aggregated positions of the active camera have the names read by the node group,
+    # the ones of the other cameras are stored with a suffix: switching camera only renames them
+    active_name = obj["smear_active_camera"]
+    if camera_name == active_name:
+        return
+
+    attributes = obj.data.attributes
+    active_suffix = get_camera_suffix(active_name)
+    new_suffix = get_camera_suffix(camera_name)
+
+    if "smear_delta_cache" in obj:
+        # Runtime deltas: each camera has its own cache file
+        delta_feed.set_delta_cache(obj,delta_feed.get_delta_cache_filepath(obj,new_suffix))
+        delta_feed.update_delta_feed(obj,bpy.context.scene.frame_current)
+    else:
+        active_deltas = [at.name for at in attributes if re.fullmatch(r"delta_-?\d+",at.name)]
+        new_deltas = [at.name for at in attributes if at.name.startswith("delta_") and at.name.endswith(new_suffix)]
+        for name in active_deltas:
+            attributes[name].name = f"{name}{active_suffix}"
+        for name in new_deltas:
+            attributes[name].name = name[:-len(new_suffix)]
+
+    objs = bpy.data.objects
+    aggregated_name = f"aggregated_animation_{obj.name}"
+    if aggregated_name in objs:
+        objs[aggregated_name].name = f"{aggregated_name}{active_suffix}"
+    objs[f"{aggregated_name}{new_suffix}"].name = aggregated_name
+
+    mod = obj.modifiers["Smear Control Panel"]
+    aggregated_identifier = mod.node_group.interface.items_tree["Aggregated"].identifier
+    mod[aggregated_identifier] = objs[aggregated_name]
+    camera_identifier = mod.node_group.interface.items_tree["Camera"].identifier
+    mod[camera_identifier] = objs[camera_name]
+
+    obj["smear_active_camera"] = camera_name
+
+def get_bake_ranges(scene,frame_start,frame_end):
+    smear = scene.smear
+    if smear.bakeRange == "RENDER":
+        return [(scene.frame_start,scene.frame_end)]
+    if smear.bakeRange == "CUSTOM":
+        return [(min(smear.rangeStart,smear.rangeEnd),max(smear.rangeStart,smear.rangeEnd))]
+    if smear.bakeRange == "LIST":
+        return parse_frame_ranges(smear.rangeList)
+    return [(frame_start,frame_end)]
+
 class BakeDeltasTrajectoriesOperator(bpy.types.Operator):
     bl_idname = "scene.bake_deltas_and_trajectories"
     bl_label = "Bake Smears"
 
-    appended_files = False
+    # Time spent baking at each timer event when running interactively, in seconds
+    time_slice = 0.1
 
-    def execute(self,context):
+    def begin_bake(self,context):
         scene = context.scene
-        if not self.appended_files:
-            path = os.path.dirname(os.path.realpath(__file__))
-            abspath = bpy.path.abspath(path)
-            filepath = os.path.join(abspath, "smear_frames_nodes.blend")
+        assets.load_assets()
 
-            node_group_name="Smear Frames Controler"
-            bpy.ops.wm.append(filepath = os.path.join(filepath, "NodeTree", node_group_name), directory = os.path.join(filepath, "NodeTree"), filename = node_group_name)
-            node_group_name="Smear Frames Controler - Multiples"
-            bpy.ops.wm.append(filepath = os.path.join(filepath, "NodeTree", node_group_name), directory = os.path.join(filepath, "NodeTree"), filename = node_group_name)
-            node_group_name="Smear Frames Controler - Lines"
-            bpy.ops.wm.append(filepath = os.path.join(filepath, "NodeTree", node_group_name), directory = os.path.join(filepath, "NodeTree"), filename = node_group_name)
+        obj = bpy.context.active_object
+        if obj is None or obj.type != 'MESH':
+            return False
 
-            material_name="Delta_Visualization"
-            bpy.ops.wm.append(filepath = os.path.join(filepath, "Material", material_name), directory = os.path.join(filepath, "Material"), filename = material_name)
+        self.obj = obj
+        self.current_frame = scene.frame_current
+        self.original_reset = None
 
-            material_name="MultipleTransparency"
-            bpy.ops.wm.append(filepath = os.path.join(filepath, "Material", material_name), directory = os.path.join(filepath, "Material"), filename = material_name)
+        armature = None
+        for mod in obj.modifiers:
+            if mod.type == "ARMATURE":
+                armature = mod.object
+
+        # Deltas are computed for every POV camera, from positions sampled once in world space. None is the world space view.
+        self.views = [None]
+        if scene.smear.cameraPOV and scene.camera != None:
+            camera_names = [name.strip() for name in scene.smear.povCameras.split(",") if name.strip() != ""]
+            cameras = [scene.objects[name] for name in camera_names if name in scene.objects and scene.objects[name].type == "CAMERA"]
+            ignored = [name for name in camera_names if not name in scene.objects or scene.objects[name].type != "CAMERA"]
+            if len(ignored) > 0:
+                self.report({'WARNING'},f"Ignored POV cameras, not cameras of the scene: {', '.join(ignored)}")
+            if len(cameras) == 0:
+                cameras = [scene.camera]
+            # The scene camera is active after the bake if it is one of the POV cameras
+            if scene.camera in cameras:
+                cameras.remove(scene.camera)
+                cameras.insert(0,scene.camera)
+            self.views = cameras
+
+        # All the views of a bake share its frame range and space: a merge must cover the same views as the previous bake,
+        # and store its deltas the same way
+        if scene.smear.mergeBake and "Smear Control Panel" in obj.modifiers:
+            mod = obj.modifiers["Smear Control Panel"]
+            previous_cameras = list(obj.get("smear_cameras",[]))
+            if len(previous_cameras) == 0 and get_modifier_input(mod,"Camera POV") and get_modifier_input(mod,"Camera") != None:
+                # Camera POV bake made before the cameras were recorded
+                previous_cameras = [get_modifier_input(mod,"Camera").name]
+            cameras = [camera.name for camera in self.views if camera != None]
+            if set(previous_cameras) != set(cameras):
+                previous = "world space" if len(previous_cameras) == 0 else ", ".join(previous_cameras)
+                self.report({'ERROR'},f"Merged bakes must use the views of the previous bake ({previous}), bake without merging to change them")
+                return False
+            if ("smear_delta_cache" in obj) != scene.smear.runtimeDeltas:
+                self.report({'ERROR'},"Merged bakes must keep the Runtime Deltas option of the previous bake")
+                return False
+
+        range_cameras = [camera for camera in self.views if camera != None]
+        if scene.camera != None and not scene.camera in range_cameras:
+            range_cameras.append(scene.camera)
+        animation_range = get_animation_range(obj,range_cameras)
+        if animation_range is None:
+            self.report({'ERROR'},"No animation found on the object, its parents, armature or camera")
+            return False
+        frame_start, frame_end = animation_range
+
+        try:
+            ranges = get_bake_ranges(scene,frame_start,frame_end)
+        except ValueError as error:
+            self.report({'ERROR'},str(error))
+            return False
+
+        # The whole animation is the reference, ranges are padded by the smoothing window for the deltas,
+        # and by one more frame for the velocities, so that range bakes match a full bake at their boundaries
+        self.frame_start = frame_start
+        self.frame_end = frame_end
+        self.bake_frames = pad_frame_ranges(ranges,0,frame_start,frame_end)
+        self.delta_frames = pad_frame_ranges(ranges,scene.smear.smoothWindow,frame_start,frame_end)
+        self.sample_frames = pad_frame_ranges(ranges,scene.smear.smoothWindow+1,frame_start,frame_end)
+
+        if len(self.bake_frames) == 0:
+            self.report({'ERROR'},f"Bake range is outside of the animation (frames {frame_start} to {frame_end})")
+            return False
+
+        bones_to_discard = []
+        if armature != None and scene.smear.discardedBone != "":
+            bone_names = [name.strip() for name in scene.smear.discardedBone.split(",") if name.strip() != ""]
+            unknown = [name for name in bone_names if not name in armature.data.bones]
+            if len(unknown) > 0:
+                self.report({'ERROR'},f"Pruned bones not found in {armature.name}: {', '.join(unknown)}")
+                return False
+            selected_bones = [armature.data.bones[name] for name in bone_names]
+            bones_to_discard = [child.name for b in selected_bones for child in b.children_recursive]
+        self.skeleton = get_skeleton(obj,bones_to_discard)
+
+        # One step to sample each frame, one step to compute the delta of each frame, one step to write the results
+        self.n_steps = len(self.sample_frames)+len(self.views)*len(self.delta_frames)+1
+        self.step = 0
+        self.steps = self.bake_steps(context)
+
+        # Once everything is validated: the animation is sampled without the smear effects,
+        # and the runtime deltas of a previous bake are not fed meanwhile. Undone by restore_original.
+        for mod in obj.modifiers:
+            if mod.type == "NODES" and not (mod.node_group is None) and mod.node_group.name == "Smear Frames Controler":
+                original_identifier = mod.node_group.interface.items_tree["Original"].identifier
+                self.original_reset = (mod.name, original_identifier, mod[original_identifier])
+                mod[original_identifier] = True
+        delta_feed.suspended.add(obj.name)
+
+        return True
+
+    def bake_steps(self,context):
+        scene = context.scene
+        obj = self.obj
+        views = self.views
+
+        # Sampled positions and joints, for each view
+        positions = [{} for view in views]
+        joints = [{} for view in views]
+
+        vertex_groups = deltagen.get_vertex_groups(obj)
+        full_body = scene.smear.fullBody
+        hold_tolerance = scene.smear.holdTolerance
+
+        # In pipelined mode, deltas are computed by worker threads as soon as the frames they need are sampled
+        workers = []
+        if scene.smear.pipelinedBake:
+            for v in range(len(views)):
+                worker = deltagen.DeltaWorker(positions[v],joints[v],vertex_groups,self.skeleton,full_body,hold_tolerance)
+                worker.start()
+                workers.append(worker)
+
+        try:
+            obj_copy = begin_anim_sampling(obj)
+            try:
+                depsgraph = context.evaluated_depsgraph_get()
+
+                def sample(frame,joints_out=None):
+                    world_positions, world_joints = sample_anim_frame(obj,obj_copy,depsgraph,frame,self.skeleton,joints_out=joints_out)
+
+                    for (v,camera) in enumerate(views):
+                        if camera is None:
+                            positions[v][frame], joints[v][frame] = world_positions, world_joints
+                        else:
+                            location, rotation = get_camera_transform(camera)
+                            positions[v][frame] = to_camera_coord(world_positions,location,rotation)
+                            joints[v][frame] = None if world_joints is None else to_camera_coord(world_joints,location,rotation)
+
+                def sample_around(frame):
+                    # The motion of a frame is measured with the next frame, or the previous one at the end of the animation
+                    for f in [frame, frame+1 if frame < self.frame_end else frame-1]:
+                        if not f in positions[0]:
+                            sample(f)
+
+                # Holds carry over the deltas of the last frame the mesh or a bone moved. So that range bakes match a full bake,
+                # ranges are extended back to a frame where everything moves in every view. Holds at the start of the animation
+                # take the deltas of the first frame that has its own, the range starting the animation is extended up to it.
+                delta_frames = set(self.delta_frames)
+                range_starts = [frame for frame in self.delta_frames if not frame-1 in delta_frames]
+                for start in range_starts:
+                    frame = start
+                    while frame > self.frame_start:
+                        sample_around(frame)
+                        if all(deltagen.is_fresh_frame(frame,positions[v],joints[v],vertex_groups,self.skeleton,full_body,hold_tolerance) for v in range(len(views))):
+                            break
+                        frame -= 1
+                        yield f"looking for the last moving frame before frame {start}"
+                    delta_frames.update(range(frame,start))
+
+                if self.frame_start in delta_frames:
+                    for v in range(len(views)):
+                        frame = self.frame_start
+                        while frame < self.frame_end:
+                            sample_around(frame)
+                            if deltagen.has_own_delta(frame,positions[v],self.skeleton,full_body,hold_tolerance):
+                                break
+                            frame += 1
+                            yield "looking for the first moving frame"
+                        delta_frames.update(range(self.frame_start,frame+1))
+
+                sample_frames = set(self.sample_frames) | delta_frames | {frame+1 for frame in delta_frames if frame < self.frame_end}
+                self.delta_frames = sorted(delta_frames)
+                self.sample_frames = sorted(sample_frames)
+                self.n_steps = len(self.sample_frames)+len(views)*len(self.delta_frames)+1
+
+                if self.skeleton is not None:
+                    joints_array = np.empty((len(self.sample_frames),len(self.skeleton["names"]),2,3))
+
+                for (i,frame) in enumerate(self.sample_frames):
+                    if not frame in positions[0]:
+                        sample(frame,joints_array[i] if self.skeleton is not None else None)
+
+                    # The delta of a frame needs the next frame, or the previous one at the end of the animation
+                    for worker in workers:
+                        if frame-1 in delta_frames:
+                            worker.put(frame-1)
+                        if frame in delta_frames and not frame+1 in sample_frames:
+                            worker.put(frame)
+
+                    self.step = i+1
+                    yield f"sampling frame {frame}"
+            finally:
+                end_anim_sampling(obj_copy)
+
+            for worker in workers:
+                worker.finish()
+            while any(worker.is_alive() for worker in workers):
+                workers[0].join(0.05)
+                self.step = len(self.sample_frames)+sum(len(worker.animation_deltas) for worker in workers)
+                yield "computing deltas"
+            for worker in workers:
+                if worker.error is not None:
+                    raise worker.error
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.stop()
+
+        if len(workers) > 0:
+            view_deltas = [worker.animation_deltas for worker in workers]
+        else:
+            view_deltas = []
+            for v in range(len(views)):
+                animation_deltas = {}
+                coherence = {}
+                for (i,frame) in enumerate(self.delta_frames):
+                    # Nothing is carried over the gaps between bake ranges
+                    if not frame-1 in animation_deltas:
+                        coherence = {}
+                    animation_deltas[frame] = deltagen.get_frame_delta_ribbon(frame,positions[v],joints[v],vertex_groups,self.skeleton,full_body=full_body,hold_tolerance=hold_tolerance,coherence=coherence)
+                    self.step = len(self.sample_frames)+v*len(self.delta_frames)+i+1
+                    yield f"computing delta for frame {frame}"
+                view_deltas.append(animation_deltas)
+
+        # The results are written with no yield in between, so a cancelled bake never leaves them half written
+        if not scene.smear.mergeBake:
+            clear_attributes(obj)
+            clear_camera_aggregated(obj)
+        elif views[0] is not None and "smear_cameras" in obj:
+            # Merged results go to the sets of the same cameras, checked in begin_bake
+            switch_smear_camera(obj,views[0].name)
+
+        runtime_deltas = scene.smear.runtimeDeltas
+        previous_range = None
+        if runtime_deltas and scene.smear.mergeBake and "smear_delta_cache" in obj:
+            previous_range = list(obj["smear_delta_frames"])
+        delta_range = None
+
+        for (v,camera) in enumerate(views):
+            # The first view is active, the others are stored with the name of their camera
+            suffix = "" if v == 0 else get_camera_suffix(camera.name)
+
+            animation_deltas = deltagen.fill_held_deltas(view_deltas[v],len(obj.data.vertices))
+            animation_deltas = deltagen.temporal_smooth_delta(animation_deltas,scene.smear.smoothWindow,self.frame_start,self.frame_end,len(obj.data.vertices),frames=self.bake_frames)
+            velocities = get_velocities_from_positions(positions[v],self.bake_frames)
+
+            aggregated_positions = {}
+            aggregated_velocities = {}
+            if scene.smear.mergeBake:
+                aggregated_positions, aggregated_velocities = read_aggregated(obj,suffix)
+            for frame in self.bake_frames:
+                aggregated_positions[frame] = positions[v][frame]
+                aggregated_velocities[frame] = velocities[frame]
+
+            if runtime_deltas:
+                # The deltas stay in a cache file, only the current frames are fed to the mesh at playback
+                cache_suffix = "" if camera is None else get_camera_suffix(camera.name)
+                filepath, delta_start, delta_end = delta_feed.save_delta_cache(obj,animation_deltas,cache_suffix,previous_range)
+                if v == 0:
+                    active_cache = filepath
+                    delta_range = (delta_start,delta_end)
+            else:
+                write_delta_attributes(obj,animation_deltas,suffix)
+            aggregated_start, aggregated_end = write_aggregated(obj,aggregated_positions,aggregated_velocities,suffix)
+
+        if runtime_deltas:
+            delta_feed.set_delta_cache(obj,active_cache,delta_range)
+        else:
+            delta_feed.remove_delta_cache(obj)
 
-            self.appended_files = True
+        if views[0] is None:
+            for key in ["smear_cameras","smear_active_camera"]:
+                if key in obj:
+                    del obj[key]
+        else:
+            obj["smear_cameras"] = [camera.name for camera in views]
+            obj["smear_active_camera"] = views[0].name
 
-        obj = bpy.context.active_object
-        if obj.type == 'MESH':
-            current_frame = bpy.context.scene.frame_current
-            clear_attributes(obj)
+        obj.select_set(True)
 
-            armature = None
-            for mod in obj.modifiers:
-                if mod.type == "NODES" and not (mod.node_group is None) and mod.node_group.name == "Smear Frames Controler":
-                    original_identifier = mod.node_group.interface.items_tree["Original"].identifier
-                    mod[original_identifier] = True
-                if mod.type == "ARMATURE":
-                    armature = mod.object
+        set_node_tree(obj,aggregated_start,aggregated_end,scene.smear.cameraPOV,views[0])
 
-            frame_start = math.inf
-            frame_end = 0
+        delta_feed.suspended.discard(obj.name)
+        scene.frame_set(self.current_frame)
 
-            keyframe_frames = get_keyframe_frames(obj)
-            if len(keyframe_frames) > 0:
-                frame_start = keyframe_frames[0]
-                frame_end = keyframe_frames[-1]
+    def run_steps(self,time_slice=None):
+        # Returns True once the bake is complete
+        start = time.perf_counter()
+        for message in self.steps:
+            self.message = message
+            if time_slice is not None and time.perf_counter()-start > time_slice:
+                return False
+        return True
 
-            if bpy.context.scene.camera != None:
-                keyframe_frames = get_keyframe_frames(bpy.context.scene.camera)
-                if len(keyframe_frames) > 0:
-                    frame_start = min(keyframe_frames[0],frame_start)
-                    frame_end = max(keyframe_frames[-1], frame_end)
+    def restore_original(self):
+        if self.original_reset is not None:
+            mod_name, original_identifier, value = self.original_reset
+            if mod_name in self.obj.modifiers:
+                self.obj.modifiers[mod_name][original_identifier] = value
+        delta_feed.suspended.discard(self.obj.name)
 
-            bones_to_discard = []
-            if armature != None and scene.smear.discardedBone != "":
-                selected_bones = [armature.data.bones[bone] for bone in scene.smear.discardedBone.split(", ")]
-                bones_to_discard = [child.name for b in selected_bones for child in b.children_recursive]
+    def execute(self,context):
+        if not self.begin_bake(context):
+            return {'CANCELLED'}
+
+        try:
+            self.run_steps()
+        except Exception as error:
+            self.abort(context)
+            raise error
+        return {'FINISHED'}
+
+    def invoke(self,context,event):
+        if not self.begin_bake(context):
+            return {'CANCELLED'}
+
+        wm = context.window_manager
+        wm.progress_begin(0,self.n_steps)
+        self.timer = wm.event_timer_add(0.01,window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self,context,event):
+        if event.type == 'ESC':
+            self.cancel(context)
+            self.report({'WARNING'},"Smear bake cancelled")
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        try:
+            finished = self.run_steps(self.time_slice)
+        except Exception as error:
+            self.cancel(context)
+            raise error
+
+        if finished:
+            self.end_modal(context)
+            return {'FINISHED'}
+
+        context.window_manager.progress_update(self.step)
+        context.workspace.status_text_set(f"Baking smears ({self.step}/{self.n_steps}): {self.message}. Press ESC to cancel")
+        return {'RUNNING_MODAL'}
+
+    def end_modal(self,context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+    def abort(self,context):
+        # Closing the generator removes the temporary object copy if sampling was running
+        self.steps.close()
+        self.restore_original()
+        context.scene.frame_set(self.current_frame)
+
+    def cancel(self,context):
+        self.abort(context)
+        self.end_modal(context)
+
+def get_baked_positions(obj,aggregated=None):
+    mod = obj.modifiers.get("Smear Control Panel")
+    if aggregated is None:
+        aggregated = get_modifier_input(mod,"Aggregated")
+    frame_start = get_modifier_input(mod,"First Frame")
+    frame_end = get_modifier_input(mod,"Last Frame")
+
+    n_frames = frame_end-frame_start+1
+    n_points = len(aggregated.data.vertices)
+    positions = np.empty(n_points*3,dtype=np.float32)
+    aggregated.data.vertices.foreach_get('co',positions)
+    positions.shape = (n_frames,n_points//n_frames,3)
+
+    return frame_start, positions
+
+class ExportMotionLinesOperator(bpy.types.Operator):
+    bl_idname = "scene.export_motion_lines"
+    bl_label = "Export Motion Lines"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    probability: bpy.props.FloatProperty(name="Probability",default=0.01,min=0,max=1)
+    speedThreshold: bpy.props.FloatProperty(name="Speed Threshold",default=0,min=0)
+    seed: bpy.props.IntProperty(name="Seed",default=0)
+    resample: bpy.props.IntProperty(name="Resample Points",default=0,min=0,description="Number of points per line, resampled along the trajectory (0 keeps one point per frame)")
+    splineType: bpy.props.EnumProperty(name="Spline Type",items=[("POLY","Poly",""),("NURBS","NURBS","")],default="POLY")
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return (not obj is None) and obj.type == "MESH" and "Smear Control Panel" in obj.modifiers
 
-            positions, joints = get_anim_vertices_and_joints(obj,frame_start,frame_end,bones_to_discard,camera_coord=scene.smear.cameraPOV)
+    def invoke(self, context, event):
+        # Start from the settings of the Motion Lines panel
+        mod = context.active_object.modifiers["Smear Control Panel"]
+        self.probability = get_modifier_input(mod,"Probability")
+        self.speedThreshold = get_modifier_input(mod,"Lines Speed threshold")
+        self.seed = get_modifier_input(mod,"Seed")
+        return context.window_manager.invoke_props_dialog(self)
 
-            animation_deltas = deltagen.get_animation_deltas_ribbon(obj,positions,joints,bpy.context.scene.camera,scene.smear.smoothWindow,full_body=scene.smear.fullBody)
+    def execute(self, context):
+        obj = context.active_object
+        mod = obj.modifiers["Smear Control Panel"]
+        frame_start, positions = get_baked_positions(obj)
+
+        seeds = select_line_seeds(positions,self.probability,self.speedThreshold,self.seed)
+        if len(seeds) == 0 or len(positions) < 2:
+            self.report({'WARNING'},"No vertex selected as seed point for lines")
+            return {'CANCELLED'}
+
+        trajectories = np.ascontiguousarray(positions[:,seeds].transpose(1,0,2))
+        if get_modifier_input(mod,"Camera POV"):
+            camera = get_modifier_input(mod,"Camera")
+            if camera is None:
+                self.report({'ERROR'},"Smear frames were baked in camera space, but the modifier has no camera")
+                return {'CANCELLED'}
+            # Camera POV bakes store positions in camera space, they are moved back to world space with the camera of each frame
+            scene = context.scene
+            current_frame = scene.frame_current
+            for t in range(trajectories.shape[1]):
+                scene.frame_set(frame_start+t)
+                trajectories[:,t] = from_camera_coord(trajectories[:,t],*get_camera_transform(camera))
+            scene.frame_set(current_frame)
+
+        if self.resample > 1:
+            trajectories = resample_trajectories(trajectories,self.resample)
+
+        name = f"motion_lines_{obj.name}"
+        curve_data = curve_from_trajectories(name,trajectories,self.splineType)
+        curve_obj = bpy.data.objects.new(name,curve_data)
+        obj.users_collection[0].objects.link(curve_obj)
+
+        self.report({'INFO'},f"Exported {len(seeds)} motion lines")
+        return {'FINISHED'}
 
-            for frame in animation_deltas:
-                dname = f"delta_{frame}"
-                obj.data.attributes.new(name=dname,type="FLOAT",domain="POINT")
-                obj.data.attributes[dname].data.foreach_set("value",animation_deltas[frame])
+# Blender does not keep references to dynamic enum items, they must be kept alive on the Python side
+baked_camera_items = []
 
+def get_baked_cameras(self, context):
+    obj = context.active_object
+    baked_camera_items[:] = [] if obj is None else [(name,name,"") for name in obj.get("smear_cameras",[])]
+    return baked_camera_items
 
-            pos_aggregated = np.concatenate([positions[frame] for frame in positions])
-            add_mesh_to_scene(f"aggregated_animation_{obj.name}",verts=pos_aggregated,edges=[],faces=[])
-            bpy.data.objects[f"aggregated_animation_{obj.name}"].hide_viewport = True
-            bpy.data.objects[f"aggregated_animation_{obj.name}"].hide_render = True
-            bpy.data.objects[f"aggregated_animation_{obj.name}"].select_set(False)
-            obj.select_set(True)
+class SwitchSmearCameraOperator(bpy.types.Operator):
+    bl_idname = "scene.switch_smear_camera"
+    bl_label = "Switch POV Camera"
+    bl_description = "Use the smear frames baked for another camera"
+    bl_options = {'REGISTER', 'UNDO'}
 
-            set_node_tree(obj,frame_start,frame_end,scene.smear.cameraPOV)
+    camera: bpy.props.EnumProperty(name="Camera",items=get_baked_cameras)
 
-            bpy.context.scene.frame_set(current_frame)
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return (not obj is None) and "smear_cameras" in obj and "Smear Control Panel" in obj.modifiers
 
+    def execute(self, context):
+        switch_smear_camera(context.active_object,self.camera)
         return {'FINISHED'}
 
-def set_node_tree(obj,frame_start,frame_end,cameraPOV):
+class FreezeSmearsOperator(bpy.types.Operator):
+    bl_idname = "scene.freeze_smears"
+    bl_label = "Freeze Smears"
+    bl_description = "Cache the result of the modifier stack to a point cache file for real-time playback"
+
+    filepath: bpy.props.StringProperty(name="Cache File",subtype="FILE_PATH",default="",description="PC2 file to write, next to the blend file if empty")
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return (not obj is None) and obj.type == "MESH" and "Smear Control Panel" in obj.modifiers and not point_cache.is_frozen(obj)
+
+    def execute(self, context):
+        obj = context.active_object
+        mod = obj.modifiers["Smear Control Panel"]
+        frame_start = get_modifier_input(mod,"First Frame")
+        frame_end = get_modifier_input(mod,"Last Frame")
+
+        filepath = bpy.path.abspath(self.filepath) if self.filepath != "" else point_cache.get_cache_filepath(obj)
+        point_cache.freeze_smears(obj,frame_start,frame_end,filepath)
+
+        if "smear_frozen_frames" in obj:
+            self.report({'INFO'},"Vertex count changes during the animation, frozen as one mesh per frame")
+        return {'FINISHED'}
+
+class UnfreezeSmearsOperator(bpy.types.Operator):
+    bl_idname = "scene.unfreeze_smears"
+    bl_label = "Unfreeze Smears"
+    bl_description = "Remove the point cache and go back to the live smear modifiers"
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return (not obj is None) and obj.type == "MESH" and point_cache.is_frozen(obj)
+
+    def execute(self, context):
+        point_cache.unfreeze_smears(context.active_object)
+        return {'FINISHED'}
+
+class SmearPlaybackBenchmarkOperator(bpy.types.Operator):
+    bl_idname = "scene.smear_playback_benchmark"
+    bl_label = "Smear Playback Benchmark"
+    bl_description = "Time the evaluation of the smear effects per frame while sweeping their parameters, and write the results to a JSON file"
+
+    filepath: bpy.props.StringProperty(name="Results File",subtype="FILE_PATH",default="//smear_benchmark.json")
+    objectName: bpy.props.StringProperty(name="Object",default="",description="Object to benchmark, the active object if empty")
+    samples: bpy.props.IntProperty(name="Samples",default=4,min=1,description="Number of values tried for each parameter")
+    frameStep: bpy.props.IntProperty(name="Frame Step",default=1,min=1)
+
+    def execute(self, context):
+        scene = context.scene
+        if self.objectName != "":
+            obj = scene.objects.get(self.objectName)
+        else:
+            obj = context.active_object
+            if obj is None or not "Smear Control Panel" in obj.modifiers:
+                # Running in background mode, there might not be an active object
+                obj = next((o for o in scene.objects if o.type == "MESH" and "Smear Control Panel" in o.modifiers),None)
+        if obj is None or not "Smear Control Panel" in obj.modifiers:
+            self.report({'ERROR'},"No object with smear frames to benchmark")
+            return {'CANCELLED'}
+
+        effects = [(panel.bl_label,panel.activate_toggle.name,[(p.name,p.gate) for p in panel.effect_parameters if not p.as_attribute])
+            for panel in [ElongatedInbetweensControlPanel,MultipleInbetweensControlPanel,MotionLinesControlPanel]]
+
+        results = benchmark.run_benchmark(scene,obj,effects,self.samples,self.frameStep)
+        filepath = bpy.path.abspath(self.filepath)
+        benchmark.write_results(filepath,results)
+
+        self.report({'INFO'},f"Benchmark results written to {filepath}")
+        return {'FINISHED'}
+
+def set_node_tree(obj,frame_start,frame_end,cameraPOV,camera=None):
     node_tree_exists = False
     armature_exists = False
     subsurface_exists = False
@@ -325,13 +947,27 @@ def set_node_tree(obj,frame_start,frame_end,cameraPOV):
     mod[cameraPOV_identifier] = cameraPOV
 
     camera_identifier = mod.node_group.interface.items_tree["Camera"].identifier
-    mod[camera_identifier] = bpy.context.scene.camera
+    mod[camera_identifier] = camera if camera != None else bpy.context.scene.camera
 
 class SmearPropertyGroup(bpy.types.PropertyGroup):
     fullBody: bpy.props.BoolProperty(name="Ignore Skeleton",default=False)
     discardedBone: bpy.props.StringProperty(name="Bones",search=get_bone_names)
     smoothWindow: bpy.props.IntProperty(name="n° frames", default=2)
     cameraPOV: bpy.props.BoolProperty(name="camera POV",default=False)
+    povCameras: bpy.props.StringProperty(name="Cameras",search=get_camera_names,description="Cameras to bake smear frames for, the scene camera if empty")
+    pipelinedBake: bpy.props.BoolProperty(name="Pipelined Bake",default=True,description="Compute the deltas in a background thread while the animation is being sampled")
+    holdTolerance: bpy.props.FloatProperty(name="Tolerance",default=1e-5,min=0,precision=6,description="Maximum displacement per frame for the mesh or a bone to be considered still, held parts reuse their previous deltas")
+    bakeRange: bpy.props.EnumProperty(name="Bake Range",items=[
+            ("KEYFRAMES","Keyframes","All keyframes of the object, its parents, armature and camera"),
+            ("RENDER","Scene Range","Frame range of the scene"),
+            ("CUSTOM","Custom Range","Custom frame range"),
+            ("LIST","Range List","List of frame ranges, e.g. 1-50, 80-120")
+        ],default="KEYFRAMES")
+    rangeStart: bpy.props.IntProperty(name="Start",default=1)
+    rangeEnd: bpy.props.IntProperty(name="End",default=250)
+    rangeList: bpy.props.StringProperty(name="Ranges",default="")
+    mergeBake: bpy.props.BoolProperty(name="Merge with Previous Bake",default=False,description="Keep the frames of the previous bake outside of the baked range")
+    runtimeDeltas: bpy.props.BoolProperty(name="Runtime Deltas",default=False,description="Store the deltas in a cache file next to the .blend and only write the deltas of the current frames to the mesh during playback")
 
 def register():
     bpy.utils.register_class(SmearPropertyGroup)
@@ -339,18 +975,48 @@ def register():
 
     bpy.utils.register_class(SmearControlPanel)
     bpy.utils.register_class(BakeDeltasTrajectoriesOperator)
+    bpy.utils.register_class(ExportMotionLinesOperator)
+    bpy.utils.register_class(FreezeSmearsOperator)
+    bpy.utils.register_class(UnfreezeSmearsOperator)
+    bpy.utils.register_class(SwitchSmearCameraOperator)
+    bpy.utils.register_class(SmearPlaybackBenchmarkOperator)
 
     bpy.utils.register_class(ElongatedInbetweensControlPanel)
     bpy.utils.register_class(MotionLinesControlPanel)
     bpy.utils.register_class(MultipleInbetweensControlPanel)
 
+    bpy.app.handlers.frame_change_pre.append(point_cache.frozen_frames_handler)
+    bpy.app.handlers.frame_change_pre.append(delta_feed.delta_feed_handler)
+    bpy.app.handlers.load_post.append(assets.clear_loaded_assets)
+    bpy.app.handlers.load_post.append(delta_feed.clear_loaded_caches)
+    bpy.app.handlers.load_post.append(clear_keyframe_indices)
+    bpy.app.handlers.depsgraph_update_post.append(invalidate_keyframe_indices)
+
 def unregister():
     bpy.utils.unregister_class(SmearPropertyGroup)
     del bpy.types.Scene.smear
 
     bpy.utils.unregister_class(SmearControlPanel)
     bpy.utils.unregister_class(BakeDeltasTrajectoriesOperator)
+    bpy.utils.unregister_class(ExportMotionLinesOperator)
+    bpy.utils.unregister_class(FreezeSmearsOperator)
+    bpy.utils.unregister_class(UnfreezeSmearsOperator)
+    bpy.utils.unregister_class(SwitchSmearCameraOperator)
+    bpy.utils.unregister_class(SmearPlaybackBenchmarkOperator)
 
     bpy.utils.unregister_class(ElongatedInbetweensControlPanel)
     bpy.utils.unregister_class(MotionLinesControlPanel)
-    bpy.utils.unregister_class(MultipleInbetweensControlPanel)
\ No newline at end of file
+    bpy.utils.unregister_class(MultipleInbetweensControlPanel)
+
+    if point_cache.frozen_frames_handler in bpy.app.handlers.frame_change_pre:
+        bpy.app.handlers.frame_change_pre.remove(point_cache.frozen_frames_handler)
+    if delta_feed.delta_feed_handler in bpy.app.handlers.frame_change_pre:
+        bpy.app.handlers.frame_change_pre.remove(delta_feed.delta_feed_handler)
+    if delta_feed.clear_loaded_caches in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(delta_feed.clear_loaded_caches)
+    if assets.clear_loaded_assets in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(assets.clear_loaded_assets)
+    if clear_keyframe_indices in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(clear_keyframe_indices)
+    if invalidate_keyframe_indices in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(invalidate_keyframe_indices)
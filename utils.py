@@ -7,7 +7,9 @@ import bmesh
 import os
 import numpy as np
 import math
+import re
 from mathutils import Vector, Matrix, Euler
+from bpy.app.handlers import persistent
 
 def add_mesh_to_scene(name,verts=None,edges=None,faces=None,override=True):
 	if override and name in bpy.data.objects:
@@ -145,12 +147,7 @@ def get_anim_joints(obj,frame_start,frame_end,camera_coord=False):
 
 	return anim_joints
 
-def get_anim_vertices_and_joints(obj,frame_start,frame_end,bones_to_discard,camera_coord=False):
-	if frame_start == None or frame_end == None:
-		keyframe_frames = get_keyframe_frames(obj)
-		frame_start = keyframe_frames[0]
-		frame_end = keyframe_frames[-1]
-
+def begin_anim_sampling(obj):
 	obj_copy = obj.copy()
 	mods_to_remove = []
 	for mod in obj_copy.modifiers:
@@ -162,73 +159,109 @@ def get_anim_vertices_and_joints(obj,frame_start,frame_end,bones_to_discard,came
 	col = obj.users_collection[0]
 	col.objects.link(obj_copy)
 
-	wm = bpy.context.window_manager
-	wm.progress_begin(0,frame_end-frame_start)
+	return obj_copy
 
-	try:
-		depsgraph = bpy.context.evaluated_depsgraph_get()
-
-		anim_vertices = {}
-		anim_joints = {}
-		for frame in range(frame_start,frame_end+1):
-			bpy.context.scene.frame_set(frame)
-			wm.progress_update(frame)
-
-			# https://blender.stackexchange.com/questions/264568/what-is-the-fastest-way-to-set-global-vertices-coordinates-to-a-numpy-array-usin
-			ob_eval = obj_copy.evaluated_get(depsgraph)
-
-			n_vertices = len(ob_eval.data.vertices)
-			rotation_and_scale = obj.matrix_world.to_3x3().transposed()
-			offset = np.array(obj.matrix_world.translation)
-			verts_temp = np.empty(n_vertices*3,dtype=np.float64)
-			ob_eval.data.vertices.foreach_get('co',verts_temp)
-			verts_temp.shape = (n_vertices,3)
-			verts_temp = np.matmul(verts_temp, rotation_and_scale)
-			verts_temp += offset
-			anim_vertices[frame] = verts_temp
-
-			if bpy.context.scene.camera != None and camera_coord:
-				camera = bpy.context.scene.camera
-				for i in range(len(anim_vertices[frame])):
-					anim_vertices[frame][i] -= camera.location
-					position_vector = Vector(anim_vertices[frame][i])
-					position_vector.rotate(camera.rotation_euler)
-					position_vector[2] *= -1
-					anim_vertices[frame][i] = np.array(position_vector)
-
-			anim_joints[frame] = {}
-			for mod in obj.modifiers:
-				if mod.type == "ARMATURE":
-					for o in bpy.context.scene.objects:
-						o.select_set(False)
-					mod.object.select_set(True)
-
-					armature = mod.object
-					M = armature.matrix_world
-					p = armature.pose
-					for b in armature.data.bones:
-						bone_name = b.name
-						if bone_name in bones_to_discard:
-							bone_name = get_closest_kept_parent(b,bones_to_discard).name
-						bone = p.bones[bone_name]
-						anim_joints[frame][b.name] = [np.array(M @ bone.head), np.array(M @ bone.tail), bone]
-
-			
-	
-	except Exception as error: # If an error occurs, we still need to delete the object copy and stop the progress bar
-		wm.progress_end()
-
-		objs = bpy.data.objects
+def end_anim_sampling(obj_copy):
+	objs = bpy.data.objects
+	if obj_copy.name in objs:
 		objs.remove(objs[obj_copy.name],do_unlink=True)
-		
-		raise error
-	
-	wm.progress_end()
 
-	objs = bpy.data.objects
-	objs.remove(objs[obj_copy.name],do_unlink=True)
+def get_modifier_input(mod,name):
+	identifier = mod.node_group.interface.items_tree[name].identifier
+	return mod[identifier]
+
+def set_modifier_input(mod,name,value):
+	identifier = mod.node_group.interface.items_tree[name].identifier
+	mod[identifier] = value
 
-	return anim_vertices, anim_joints
+def get_camera_transform(camera):
+	return np.array(camera.location), np.array(camera.rotation_euler.to_matrix())
+
+def to_camera_coord(points,location,rotation):
+	# Points are moved to the camera location, rotated by the camera rotation, and their z axis flipped
+	coords = (points - location) @ rotation.T
+	coords[...,2] *= -1
+	return coords
+
+def from_camera_coord(coords,location,rotation):
+	# Inverse of to_camera_coord
+	points = np.array(coords,dtype=np.float64)
+	points[...,2] *= -1
+	return points @ rotation + location
+
+def get_skeleton(obj,bones_to_discard):
+	armature = None
+	for mod in obj.modifiers:
+		if mod.type == "ARMATURE":
+			armature = mod.object
+	if armature is None:
+		return None
+
+	# The hierarchy is copied to plain Python data so that deltas can be computed without accessing Blender data
+	bones = armature.data.bones
+	names = [b.name for b in bones]
+	index = {name: i for (i,name) in enumerate(names)}
+	parents = [None if b.parent is None else b.parent.name for b in bones]
+	children = [[c.name for c in b.children] for b in bones]
+
+	# Discarded bones take the joints of their closest kept parent
+	kept = [index[get_closest_kept_parent(b,bones_to_discard).name] if b.name in bones_to_discard else i for (i,b) in enumerate(bones)]
+
+	# Pose bones are read in bulk in their own order, gather them in the order of the armature bones
+	pose_index = {pb.name: i for (i,pb) in enumerate(armature.pose.bones)}
+	gather = np.array([pose_index[names[k]] for k in kept],dtype=np.int64)
+
+	return {
+		"armature": armature,
+		"names": names,
+		"index": index,
+		"parents": parents,
+		"children": children,
+		"kept": kept,
+		"gather": gather
+	}
+
+def sample_joints(skeleton,out=None):
+	# Returns the (n_bones, 2, 3) world positions of the head and tail of every bone
+	armature = skeleton["armature"]
+	pose_bones = armature.pose.bones
+	n_pose_bones = len(pose_bones)
+
+	local_joints = np.empty((n_pose_bones,2,3))
+	heads = np.empty(n_pose_bones*3)
+	tails = np.empty(n_pose_bones*3)
+	pose_bones.foreach_get('head',heads)
+	pose_bones.foreach_get('tail',tails)
+	local_joints[:,0] = heads.reshape(n_pose_bones,3)
+	local_joints[:,1] = tails.reshape(n_pose_bones,3)
+
+	M = np.array(armature.matrix_world)
+	if out is None:
+		out = np.empty((len(skeleton["gather"]),2,3))
+	np.matmul(local_joints[skeleton["gather"]],M[:3,:3].T,out=out)
+	out += M[:3,3]
+	return out
+
+def sample_anim_frame(obj,obj_copy,depsgraph,frame,skeleton,joints_out=None):
+	bpy.context.scene.frame_set(frame)
+
+	# https://blender.stackexchange.com/questions/264568/what-is-the-fastest-way-to-set-global-vertices-coordinates-to-a-numpy-array-usin
+	ob_eval = obj_copy.evaluated_get(depsgraph)
+
+	n_vertices = len(ob_eval.data.vertices)
+	rotation_and_scale = obj.matrix_world.to_3x3().transposed()
+	offset = np.array(obj.matrix_world.translation)
+	verts_temp = np.empty(n_vertices*3,dtype=np.float64)
+	ob_eval.data.vertices.foreach_get('co',verts_temp)
+	verts_temp.shape = (n_vertices,3)
+	verts_temp = np.matmul(verts_temp, rotation_and_scale)
+	verts_temp += offset
+
+	joints = None
+	if skeleton is not None:
+		joints = sample_joints(skeleton,joints_out)
+
+	return verts_temp, joints
 
 def get_closest_kept_parent(bone,bones_to_discard):
 	parent = bone.parent
@@ -236,28 +269,85 @@ def get_closest_kept_parent(bone,bones_to_discard):
 		return parent
 	return get_closest_kept_parent(parent, bones_to_discard)
 
-def get_keyframe_frames(obj):
+TRANSFORM_DATA_PATHS = ('location','rotation_euler','rotation_quaternion','scale')
+
+# Keyframe frames of every f-curve, by action. Invalidated when the action is updated or its keyframe count changes
+keyframe_indices = {}
+
+def get_keyframe_index(action):
+	signature = tuple(len(fc.keyframe_points) for fc in action.fcurves)
+	index = keyframe_indices.get(action.session_uid)
+	if index is None or index["signature"] != signature:
+		fcurves = []
+		for fc in action.fcurves:
+			co = np.empty(len(fc.keyframe_points)*2,dtype=np.float64)
+			fc.keyframe_points.foreach_get('co',co)
+			fcurves.append((fc.data_path,np.trunc(co[0::2]).astype(np.int64)))
+		index = {"signature": signature, "fcurves": fcurves, "queries": {}}
+		keyframe_indices[action.session_uid] = index
+	return index
+
+def get_action_keyframes(action,data_paths):
+	# Sorted unique keyframe frames of the f-curves whose data path ends with one of data_paths
+	index = get_keyframe_index(action)
+	queries = index["queries"]
+	if not data_paths in queries:
+		frames = [f for (data_path,f) in index["fcurves"] if data_path.endswith(data_paths)]
+		queries[data_paths] = np.unique(np.concatenate(frames)) if len(frames) > 0 else np.empty(0,dtype=np.int64)
+	return queries[data_paths]
+
+def get_object_keyframes(obj):
 	keyframe_frames = []
 	if obj.type in ['MESH','ARMATURE','CAMERA']:
 		if obj.animation_data and obj.animation_data.action:
-			for fc in obj.animation_data.action.fcurves :
-				if fc.data_path.endswith(('location','rotation_euler','rotation_quaternion','scale')):
-					for key in fc.keyframe_points :
-						keyframe_frames.append(int(key.co[0]))
+			keyframe_frames.append(get_action_keyframes(obj.animation_data.action,TRANSFORM_DATA_PATHS))
 
 		if obj.data.animation_data and obj.data.animation_data.action:
-			for fc in obj.data.animation_data.action.fcurves :
-				if fc.data_path.endswith(('location','rotation_euler','rotation_quaternion','scale','co')):
-					for key in fc.keyframe_points :
-						keyframe_frames.append(int(key.co[0]))
+			keyframe_frames.append(get_action_keyframes(obj.data.animation_data.action,TRANSFORM_DATA_PATHS+('co',)))
 
 	if obj.parent != None:
-		keyframe_frames += get_keyframe_frames(obj.parent)
+		keyframe_frames.append(get_object_keyframes(obj.parent))
 	for mod in obj.modifiers:
 		if mod.type == "ARMATURE":
-			keyframe_frames += get_keyframe_frames(mod.object)
+			keyframe_frames.append(get_object_keyframes(mod.object))
 
-	return sorted(list(set(keyframe_frames)))
+	if len(keyframe_frames) == 0:
+		return np.empty(0,dtype=np.int64)
+	return np.unique(np.concatenate(keyframe_frames))
+
+def get_keyframe_frames(obj):
+	return get_object_keyframes(obj).tolist()
+
+def get_keyframe_range(obj):
+	# (first, last) keyframe of the object, its parents and armatures, None if it is not animated
+	frames = get_object_keyframes(obj)
+	if len(frames) == 0:
+		return None
+	return int(frames[0]), int(frames[-1])
+
+def get_animation_range(obj,cameras=[]):
+	# Keyframe range of the object and of the cameras, None if none of them is animated
+	ranges = [get_keyframe_range(obj)]
+	for camera in cameras:
+		ranges.append(get_keyframe_range(camera))
+	ranges = [r for r in ranges if r is not None]
+	if len(ranges) == 0:
+		return None
+	return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+def get_keyframes_in_range(obj,frame_start,frame_end):
+	frames = get_object_keyframes(obj)
+	return frames[np.searchsorted(frames,frame_start,side='left'):np.searchsorted(frames,frame_end,side='right')].tolist()
+
+@persistent
+def invalidate_keyframe_indices(scene,depsgraph):
+	for update in depsgraph.updates:
+		if isinstance(update.id,bpy.types.Action):
+			keyframe_indices.pop(update.id.session_uid,None)
+
+@persistent
+def clear_keyframe_indices(dummy):
+	keyframe_indices.clear()
 
 def warp(x,b):
 	return ((2*(x+1))/(-math.exp(-b)*(x-1)+x+1))-1
@@ -265,47 +355,108 @@ def warp(x,b):
 def warp_deltas(deltas,b):
 	return np.array([warp(deltas[i],b) for i in range(len(deltas))])
 
+def curve_from_trajectories(name,trajectories,spline_type='POLY'):
+	n_lines, n_points, _ = trajectories.shape
+
+	curve_data = bpy.data.curves.new(name, type='CURVE')
+	curve_data.dimensions = '3D'
+	curve_data.resolution_u = 20
+
+	# Spline points take homogeneous coordinates, filled for all lines at once and set in bulk per spline
+	coords = np.ones((n_lines,n_points,4),dtype=np.float32)
+	coords[:,:,:3] = trajectories
+	coords.shape = (n_lines,n_points*4)
+
+	for i in range(n_lines):
+		spline = curve_data.splines.new(spline_type)
+		spline.points.add(n_points-1)
+		spline.points.foreach_set('co',coords[i])
+		if spline_type == 'NURBS':
+			spline.use_endpoint_u = True
+
+	return curve_data
+
 def curve_from_points(coords):
-	curveData = bpy.data.curves.new('MyCurve', type='CURVE')
-	curveData.dimensions = '3D'
-	curveData.resolution_u = 20
-
-	polyline = curveData.splines.new('BEZIER')
-	polyline.bezier_points.add(len(coords)-1)
-	for i, coord in enumerate(coords):
-		x,y,z = coord
-		# polyline.points[i].co = (x, y, z, 1)
-		polyline.bezier_points[i].co = (x,y,z)
-		# polyline.bezier_points[i].handle_left = (x, y, z)
-		# polyline.bezier_points[i].handle_right = (x, y, z)
-
-		polyline.bezier_points[i].handle_right_type = 'AUTO'
-		polyline.bezier_points[i].handle_left_type = 'AUTO'
+	curveData = curve_from_trajectories('MyCurve',np.array(coords,dtype=np.float32)[np.newaxis])
 
 	# create Object
-	curveOB = bpy.context.scene.objects.new('myCurve', curveData)
+	curveOB = bpy.data.objects.new('myCurve', curveData)
 
 	# attach to scene and validate context
-	col = bpy.data.collections["Collection"]
+	if "Collection" in bpy.data.collections:
+		col = bpy.data.collections["Collection"]
+	else:
+		col = bpy.context.scene.collection
 	col.objects.link(curveOB)
 
-def get_velocities(obj,frame_start=None,frame_end=None):
-	if frame_start == None or frame_end == None:
-		keyframe_frames = get_keyframe_frames(obj)
-		frame_start = keyframe_frames[0]
-		frame_end = keyframe_frames[-1]
-
-	original_anim_vertices = get_anim_vertices(obj,frame_start,frame_end)
-
-	velocities = {}
-	for frame in range(frame_start,frame_end+1):
-		# velocities[frame] = original_anim_vertices[frame+1] - original_anim_vertices[frame]
-		if frame != frame_end:
-			velocities[frame] = original_anim_vertices[frame+1] - original_anim_vertices[frame]
-		else:
-			velocities[frame] = original_anim_vertices[frame] - original_anim_vertices[frame]
-
-	return velocities
+	return curveOB
+
+def select_line_seeds(positions,probability,speed_threshold,seed):
+	n_vertices = positions.shape[1]
+	if len(positions) > 1:
+		peak_speeds = np.max(np.linalg.norm(np.diff(positions,axis=0),axis=2),axis=0)
+	else:
+		peak_speeds = np.zeros(n_vertices)
+
+	rng = np.random.default_rng(seed)
+	selected = rng.random(n_vertices) < probability
+	return np.flatnonzero(selected & (peak_speeds >= speed_threshold))
+
+def resample_trajectories(trajectories,n_samples):
+	# Resample every line uniformly along its arc length; static lines are resampled uniformly in time
+	n_lines, n_frames, _ = trajectories.shape
+	segment_lengths = np.linalg.norm(np.diff(trajectories,axis=1),axis=2)
+	arc_lengths = np.concatenate((np.zeros((n_lines,1)),np.cumsum(segment_lengths,axis=1)),axis=1)
+	total_lengths = arc_lengths[:,-1:]
+	uniform = np.tile(np.linspace(0,1,n_frames),(n_lines,1))
+	arc_lengths = np.divide(arc_lengths,total_lengths,out=uniform,where=total_lengths > 0)
+
+	samples = np.linspace(0,1,n_samples)
+	resampled = np.empty((n_lines,n_samples,3),dtype=trajectories.dtype)
+	for i in range(n_lines):
+		for k in range(3):
+			resampled[i,:,k] = np.interp(samples,arc_lengths[i],trajectories[i,:,k])
+
+	return resampled
+
+def get_velocities_from_positions(positions,frames=None):
+	# positions is a dict of sampled frames, stacked to (T, V, 3). Forward differences,
+	# backward difference when the next frame is not sampled, zero for isolated frames
+	sampled = np.array(sorted(positions))
+	stacked = np.stack([positions[frame] for frame in sampled])
+	differences = np.diff(stacked,axis=0)
+	contiguous = np.diff(sampled) == 1
+
+	forward = np.append(contiguous,False)
+	backward = ~forward & np.insert(contiguous,0,False)
+	velocities = np.zeros_like(stacked)
+	velocities[forward] = differences[np.nonzero(forward)[0]]
+	velocities[backward] = differences[np.nonzero(backward)[0]-1]
+
+	if frames is None:
+		frames = sampled.tolist()
+	index = {frame: i for (i,frame) in enumerate(sampled)}
+	return {frame: velocities[index[frame]] for frame in frames}
+
+def parse_frame_ranges(text):
+	# "1-50, 80-120, 200" -> [(1,50),(80,120),(200,200)]
+	ranges = []
+	for part in text.split(","):
+		if part.strip() == "":
+			continue
+		match = re.fullmatch(r"\s*(-?\d+)\s*(?:-\s*(-?\d+))?\s*",part)
+		if match is None:
+			raise ValueError(f"Invalid frame range \"{part.strip()}\"")
+		start = int(match.group(1))
+		end = int(match.group(2)) if match.group(2) is not None else start
+		ranges.append((min(start,end),max(start,end)))
+	return ranges
+
+def pad_frame_ranges(ranges,padding,frame_min,frame_max):
+	frames = set()
+	for (start,end) in ranges:
+		frames.update(range(max(frame_min,start-padding),min(frame_max,end+padding)+1))
+	return sorted(frames)
 
 def smooth_step(x):
 	if x <= 0: